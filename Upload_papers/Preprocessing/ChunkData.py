@@ -16,9 +16,9 @@ class Document(BaseModel):
     title: str
     document_summary: str = Field(
         default="",
-        description="Short paragraph condensed from per-section sentences; no repetition of terms, one consistent summary.",)
+        description="Short paragraph summarizing the paper's sections in one LLM call; no repetition of terms, one consistent summary.",)
     document_summary_embedding: Optional[List[float]] = Field(
-        None, description="Embedding of document_summary (OpenAI text-embedding-3-small), set in parse_document."
+        None, description="Embedding of document_summary (OpenAI text-embedding-3-small), set in embed_documents."
     )
 
     
@@ -1,29 +1,200 @@
-# Chunk learning materials by section/subsection (LlamaIndex SentenceSplitter), then embed with OpenAI text-embedding-3.
-import json
+# Chunk learning materials by section/subsection (linear regex sentence splitter), then embed with OpenAI text-embedding-3.
+import asyncio
+import hashlib
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import lru_cache
 import os
 import re
-from typing import List, Optional, Tuple
+from typing import Callable, Iterator, List, Optional, Tuple
 
-from llama_index.core import Document as LlamaIxDocument
-from llama_index.core.node_parser import SentenceSplitter
-from openai import OpenAI
+import diskcache
+import httpx
+import tiktoken
+from openai import AsyncOpenAI, BadRequestError, OpenAI
 from pypdf import PdfReader
 
 
 from Preprocessing.ChunkData import Document, RAGChunk
 
+# Chunk size and overlap in tokens (cl100k_base)
 CHUNK_SIZE = 500
 CHUNK_OVERLAP = 100
 
+_SENTENCE_ENDS = frozenset(".!?")
+# str.translate table deleting ASCII digits (non-ASCII text falls back to str.isdigit per char)
+_DIGIT_TABLE = str.maketrans("", "", "0123456789")
+
+# str.translate table deleting null bytes and control chars other than \t \n \r
+_SANITIZE_TABLE = {i: None for i in range(32) if i not in (9, 10, 13)}
+
+# Line patterns, compiled once (run on every line of every page)
+_ABSTRACT_RE = re.compile(r"^\s*abstract\s*$", re.IGNORECASE)
+# A sentence (up to end punctuation followed by whitespace or end of text, plus that whitespace) or a trailing
+# run without such an end; punctuation inside a token ("3.5", "e.g.x") does not end a sentence. findall covers
+# the whole text, so concatenating the pieces gives it back unchanged
+_SENT_RE = re.compile(r"(?:[^.!?]|[.!?]+(?=[^\s.!?]))*[.!?]+(?=\s|$)\s*|.+", re.DOTALL)
+_LINE_PIECE_RE = re.compile(r"[^\n]*\n+|[^\n]+")
+_WORD_PIECE_RE = re.compile(r"\S+\s*|\s+")
+_REF_HDR_RE = re.compile(r"^\d+(\.\d+)*\s+(references|bibliography)(\s|$)")
+_SECTION_NUMBERED_RE = re.compile(r"^\s*(\d+(?:\.\d+)*)\s+(.+?)\s*$")
+
+EMBEDDING_MODEL = "text-embedding-3-small"
+# OpenAI embeddings limits per request (tokens kept below the 300k hard limit), and how many requests
+# may be in flight at once
+EMBED_MAX_INPUTS = 2048
+EMBED_MAX_TOKENS = 250_000
+EMBED_MAX_CONCURRENCY = 5
+# Embeddings of already seen content, keyed on (model, content hash); survives restarts
+EMBED_CACHE_DIR = ".embed_cache"
+
+# Shared by every OpenAI request; retries reuse the same client instead of rebuilding it
+OPENAI_TIMEOUT = httpx.Timeout(60.0, connect=5.0)
+OPENAI_MAX_RETRIES = 3
+
+# Supabase chunk rows per insert request, and how many inserts may run at once
+STORE_BATCH_SIZE = 500
+STORE_MAX_WORKERS = 4
+
+
+_AUTHOR_CHARS = frozenset("†‡⋆@")
+_AUTHOR_KEYWORDS = ("university", "research", "institute", ".com")
+
+_LINE_BODY = "body"
+_LINE_HEADER = "header"
+_LINE_REFS = "references"
+_LINE_APPENDIX = "appendix"
+
+
+def _looks_like_author_line(line: str) -> bool:
+    """Author / affiliation line on the first page: e-mail, affiliation keyword, footnote marks or a name list."""
+    lower = line.lower()
+    if any(k in lower for k in _AUTHOR_KEYWORDS):
+        return True
+    # Single C-level scan for any of the marker characters
+    if not _AUTHOR_CHARS.isdisjoint(line):
+        return True
+    return line.count(",") >= 2
+
+
+
+def _classify_line(line: str, in_references: bool) -> Tuple[str, Optional[re.Match]]:
+    """
+    Classify one stripped line of the paper body, sharing the lower()/split() work across all tests.
+    Returns (kind, match): kind is _LINE_HEADER (numbered section/subsection title), _LINE_REFS (References /
+    Bibliography header, standalone like '6 References' or a numbered heading about references),
+    _LINE_APPENDIX (a heading containing 'Appendix'/'Appendices'; only looked for inside references, where it
+    resumes chunking) or _LINE_BODY. match is the numbered-heading match for _LINE_HEADER / _LINE_APPENDIX.
+    """
+    words = line.split()
+    nw = len(words)
+    # Every kind of heading is at most 15 words
+    if not nw or nw > 15:
+        return _LINE_BODY, None
+    low = line.lower()
+
+    if in_references:
+        if ("appendix" in low or "appendices" in low) and len(line) <= 120:
+            match = _SECTION_NUMBERED_RE.match(line)
+            return _LINE_APPENDIX, match
+        return _LINE_BODY, None
+
+    # Standalone references header, not titles like 'Learning to Retrieve References'
+    if nw <= 10:
+        if low in ("references", "bibliography") or _REF_HDR_RE.match(low):
+            return _LINE_REFS, None
+        if nw <= 4 and (low.startswith("references ") or low.startswith("bibliography ")):
+            return _LINE_REFS, None
+
+    match = _SECTION_NUMBERED_RE.match(line)
+    if match:
+        title = match.group(2).strip().lower()
+        if "references" in title or "bibliography" in title:
+            return _LINE_REFS, None
+        return _LINE_HEADER, match
+    return _LINE_BODY, None
+
+
+
+@lru_cache(maxsize=None)
+def _openai_client() -> OpenAI:
+    """One OpenAI client per process, created on first use (parse workers never make API calls), so its
+    connection pool is reused across all chat requests. Embeddings use their own AsyncOpenAI client."""
+    return OpenAI(timeout=OPENAI_TIMEOUT, max_retries=OPENAI_MAX_RETRIES)
+
+
+
+def _is_context_length_error(e: BadRequestError) -> bool:
+    """True if OpenAI rejected the request for exceeding the model's context / token limit."""
+    return getattr(e, "code", None) == "context_length_exceeded" or "maximum context length" in str(e).lower()
+
+
+
+@lru_cache(maxsize=None)
+def _encoding() -> tiktoken.Encoding:
+    """cl100k_base tokenizer, loaded once per process; sizes chunks and embedding batches."""
+    return tiktoken.get_encoding("cl100k_base")
+
+
+
+async def _gather_all(*aws) -> None:
+    """Run all awaitables to completion, then re-raise the first failure. A plain gather would raise on the
+    first error and let the still-running batches (already sent and billed) be cancelled before on_batch runs."""
+    results = await asyncio.gather(*aws, return_exceptions=True)
+    for result in results:
+        if isinstance(result, BaseException):
+            raise result
+
+
+
+def _content_key(text: str) -> bytes:
+    """Hash of whitespace-normalized text; identical chunks (boilerplate, repeated paragraphs) share one key."""
+    return hashlib.blake2b(" ".join(text.split()).encode(), digest_size=16).digest()
+
+
+
+def _iter_body_lines(first_page_lines: List[str], rest_page_texts: List[str]) -> Iterator[str]:
+    """Yield the stripped, non-empty lines of the document body straight from the page texts, without
+    building one concatenated document string."""
+    for ln in first_page_lines:
+        ln = ln.strip()
+        if ln:
+            yield ln
+    for page_text in rest_page_texts:
+        for ln in page_text.split("\n"):
+            ln = ln.strip()
+            if ln:
+                yield ln
+
+
+
+def _page_text(page) -> str:
+    """Page text in pypdf's plain extraction mode (no layout positioning); older pypdf has no extraction_mode."""
+    try:
+        return page.extract_text(extraction_mode="plain") or ""
+    except TypeError:
+        return page.extract_text() or ""
+
+
+
+def _extract_pages_text(pages) -> List[str]:
+    """Extract the text of each page, in order. Serial on purpose: a PdfReader reads one shared stream and is
+    not thread-safe; parallelism comes from parsing documents in the process pool. Not stripped: every
+    consumer strips line by line."""
+    return [_page_text(page) for page in pages]
+
+
+
+def _parse_one(doc_path: str) -> Tuple[Document, List[RAGChunk], List[Tuple[str, str]]]:
+    """Process-pool worker: parse one PDF (pypdf + regex + tiktoken only, no API calls)."""
+    return Document_processing([doc_path], None).parse_document(doc_path)
+
+
 
 class Document_processing:
-    def __init__(self, documents_paths, supabase_client):
+    def __init__(self, documents_paths, supabase_client, num_workers: int = min(os.cpu_count() or 1, 4)):
         self.documents = documents_paths
         self.supabase_client = supabase_client
-        self.sentence_splitter = SentenceSplitter(
-            chunk_size=CHUNK_SIZE,
-            chunk_overlap=CHUNK_OVERLAP,
-        )
+        self.num_workers = num_workers
 
 
 
@@ -33,106 +204,58 @@ class Document_processing:
 
 
 
-    def _extract_title_and_abstract_from_pdf(self, doc_path: str) -> Tuple[str, str]:
-        """Extract title and abstract from the first page. Returns (title, abstract)."""
-        reader = PdfReader(doc_path)
-        first_page_text = (reader.pages[0].extract_text() or "").strip()
-        if not first_page_text:
-            return "", ""
-
-        lines = [ln.strip() for ln in first_page_text.split("\n") if ln.strip()]
-        if not lines:
-            return "", ""
-
-        def _looks_like_author_line(line: str) -> bool:
-            lower = line.lower()
-            if "@" in line or ".com" in lower:
-                return True
-            if any(c in line for c in "†‡⋆"):
-                return True
-            if "university" in lower or "research" in lower or "institute" in lower:
-                return True
-            if line.count(",") >= 2:
-                return True
-            return False
+    def _parse_first_page(self, first_page_lines: List[str]) -> Tuple[str, Optional[int]]:
+        """
+        Single pass over the first page lines (page 0 text split on newlines).
+        Returns (title, abstract_start): index of the line right after the "Abstract" header, or None if there is none.
+        """
 
+        # Title: lines before the authors (or the "Abstract" header)
+        first_line = None
         title_parts = []
-        for ln in lines:
-            if re.match(r"^\s*abstract\s*$", ln, re.IGNORECASE):
-                break
-            if _looks_like_author_line(ln):
-                break
-            title_parts.append(ln)
-        title = " ".join(title_parts).strip() if title_parts else lines[0]
-
-        abstract_lines = []
-        for i, line in enumerate(lines):
-            if re.match(r"^\s*abstract\s*$", line, re.IGNORECASE):
-                for ln in lines[i + 1 :]:
-                    if re.match(r"^\s*\d+\.?\s", ln):
-                        break
-                    if re.match(r"^\s*(introduction|keywords|index terms)\s*$", ln, re.IGNORECASE):
-                        break
-                    if ln.strip().lower().startswith("arxiv:"):
-                        break
-                    abstract_lines.append(ln)
+        in_title = True
+        abstract_start = None
+        for i, raw in enumerate(first_page_lines):
+            ln = raw.strip()
+            if not ln:
+                continue
+            if first_line is None:
+                first_line = ln
+            if _ABSTRACT_RE.match(ln):
+                abstract_start = i + 1
                 break
-        abstract = " ".join(abstract_lines).strip()
-        return title, abstract
-
-
-
-
-    def _extract_section_usage_line(self, section_text: str) -> str:
-        """One sentence per section: what this paper used/proposed/found in this section."""
-        if not section_text or not section_text.strip():
-            return ""
-        client = OpenAI()
-        resp = client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=[
-                {
-                    "role": "system",
-                    "content": (
-                        "You are given a section of an academic paper. Write exactly ONE short line (one sentence) "
-                        "that states what was used, proposed, or found in THIS section. Keep it as short and concise "
-                        "as possible, no filler words. Include key terms: model names, dataset names, method names, "
-                        "metrics, or tools. Mention only what this paper did, not prior or related work. Do NOT start "
-                        "with 'This paper' or 'The paper'; start directly with the fact, method, or result. The line "
-                        "will be used for search, so pack in the important keywords. Reply with only that one line, "
-                        "nothing else."
-                    ),
-                },
-                {"role": "user", "content": f"Section text:\n{section_text[:8000]}"},
-            ],
-            temperature=0,
-        )
-        line = (resp.choices[0].message.content or "").strip()
-        return line.split("\n")[0].strip() if line else ""
+            if in_title:
+                if _looks_like_author_line(ln):
+                    in_title = False
+                else:
+                    title_parts.append(ln)
+        title = " ".join(title_parts).strip() if title_parts else (first_line or "")
+        return title, abstract_start
 
 
 
 
-    def _condense_sentences_to_summary(self, section_sentences: List[str]) -> str:
-        """Take per-section sentences and produce one short paragraph: no repetition of terms, consistent and concise."""
-        if not section_sentences:
+    def _summarize_document(self, sections: List[Tuple[str, str]]) -> str:
+        """One request over all (section title, section text) pairs: one short paragraph summarizing the document."""
+        if not sections:
             return ""
-        client = OpenAI()
-        sentences_text = "\n".join(f"- {s}" for s in section_sentences)
+        sections_text = "\n\n".join(f"## {title}\n{text[:2000]}" for title, text in sections)
+        client = _openai_client()
         resp = client.chat.completions.create(
             model="gpt-4o-mini",
             messages=[
                 {
                     "role": "system",
                     "content": (
-                        "You are given one sentence per section of an academic paper. Write ONE short paragraph "
-                        "that summarizes the document. Do NOT repeat the same ideas,"
-                        "merge and rephrase so each point is said once. The paragraph should read as one consistent "
-                        "summary, concise and with no filler. Include key terms (models, datasets, methods, results). "
-                        "Reply with only the paragraph, nothing else."
+                        "You are given the sections of an academic paper. Write ONE short paragraph that summarizes "
+                        "what this paper used, proposed, or found. Do NOT repeat the same ideas, say each point once. "
+                        "The paragraph should read as one consistent summary, concise and with no filler. Include key "
+                        "terms: model names, dataset names, method names, metrics, results, or tools. Mention only what "
+                        "this paper did, not prior or related work. The summary will be used for search, so pack in the "
+                        "important keywords. Reply with only the paragraph, nothing else."
                     ),
                 },
-                {"role": "user", "content": f"Section sentences:\n{sentences_text}"},
+                {"role": "user", "content": f"Sections:\n{sections_text}"},
             ],
             temperature=0,
         )
@@ -142,71 +265,135 @@ class Document_processing:
 
     def _is_proper_chunk_text(self, content: str) -> bool:
         """True only if content looks like real prose: sentence structure, word shape, no broken PDF or number runs."""
+        # Cheap rejections first, before any per-char / per-word stats
         s = content.strip()
-        words = [w for w in s.split() if w]
-        if not s or len(s) < 35 or len(words) < 5:
+        n = len(s)
+        if n < 35:
             return False
-        n, nw = len(s), len(words)
-        digits = sum(1 for c in s if c.isdigit()) / max(n, 1)
-        single = sum(1 for w in words if len(w) == 1) / max(nw, 1)
-        alpha = sum(1 for w in words if any(c.isalpha() for c in w)) / nw
-        unique = len(set(w.lower() for w in words)) / max(nw, 1)
-        avg_len = sum(len(w) for w in words) / max(nw, 1)
-        has_end = any(c in s for c in ".!?")
-        return (
-            digits <= 0.4 and single <= 0.28 and alpha >= 0.5 and unique >= 0.3
-            and (has_end or avg_len >= 3.2)
-            and not (s.isupper() and n < 80)
-        )
+        words = s.split()
+        nw = len(words)
+        if nw < 5:
+            return False
+        if s.isupper() and n < 80:
+            return False
+
+        # Digit count and sentence-ending punctuation via C-level scans (translate / isdisjoint) for ASCII text
+        if s.isascii():
+            n_digits = n - len(s.translate(_DIGIT_TABLE))
+        else:
+            n_digits = sum(c.isdigit() for c in s)
+        if n_digits / n > 0.4:
+            return False
+        has_end = not _SENTENCE_ENDS.isdisjoint(s)
+
+        # One pass over the words: single-letter, non-alphabetic, unique (lowercased) words and total length.
+        # Bail out as soon as the single-letter or alphabetic ratio can no longer pass.
+        n_single = n_non_alpha = sum_len = 0
+        seen = {}
+        for w in words:
+            lw = len(w)
+            sum_len += lw
+            if lw == 1:
+                n_single += 1
+                if n_single / nw > 0.28:
+                    return False
+            if not (w.isalpha() or any(c.isalpha() for c in w)):
+                n_non_alpha += 1
+                if (nw - n_non_alpha) / nw < 0.5:
+                    return False
+            seen[w.lower()] = None
+
+        return len(seen) / nw >= 0.3 and (has_end or sum_len / nw >= 3.2)
 
     def _chunk_section(self, text: str) -> List[str]:
-        """Chunk text using LlamaIndex SentenceSplitter (chunk_size=100, overlap=20)."""
+        """Chunk text into sentence-aligned chunks of at most CHUNK_SIZE tokens (cl100k_base), the next chunk starting
+        with the last sentences (up to CHUNK_OVERLAP tokens) of the previous one. One regex pass, then greedy packing."""
         text = text.strip()
         if not text:
             return []
-        doc = LlamaIxDocument(text=text)
-        nodes = self.sentence_splitter.get_nodes_from_documents([doc], show_progress=False)
-        return [node.get_content() for node in nodes if node.get_content().strip()]
-
+        enc = _encoding()
+
+        # (piece, token count) for each sentence; over-long ones (odd blocks without punctuation) fall back to
+        # lines, then words, then token windows
+        pieces: List[Tuple[str, int]] = []
+        for sent in _SENT_RE.findall(text) or [text]:
+            n_tokens = len(enc.encode_ordinary(sent))
+            if n_tokens <= CHUNK_SIZE:
+                pieces.append((sent, n_tokens))
+                continue
+            for line in _LINE_PIECE_RE.findall(sent):
+                n_tokens = len(enc.encode_ordinary(line))
+                if n_tokens <= CHUNK_SIZE:
+                    pieces.append((line, n_tokens))
+                    continue
+                for word in _WORD_PIECE_RE.findall(line):
+                    tokens = enc.encode_ordinary(word)
+                    for i in range(0, len(tokens), CHUNK_SIZE):
+                        window = tokens[i : i + CHUNK_SIZE]
+                        pieces.append((enc.decode(window), len(window)))
+
+        chunks: List[str] = []
+        current: List[Tuple[str, int]] = []
+        current_len = 0
+        for piece, n_tokens in pieces:
+            if current and current_len + n_tokens > CHUNK_SIZE:
+                chunks.append("".join(p for p, _ in current).strip())
+                # Carry the trailing pieces (at most CHUNK_OVERLAP tokens) over as the start of the next chunk
+                overlap: List[Tuple[str, int]] = []
+                overlap_len = 0
+                for prev in reversed(current):
+                    if overlap_len + prev[1] > CHUNK_OVERLAP or overlap_len + prev[1] + n_tokens > CHUNK_SIZE:
+                        break
+                    overlap.append(prev)
+                    overlap_len += prev[1]
+                current = overlap[::-1]
+                current_len = overlap_len
+            current.append((piece, n_tokens))
+            current_len += n_tokens
+        if current:
+            chunks.append("".join(p for p, _ in current).strip())
+        return [c for c in chunks if c]
 
 
 
 
-    def process_document(self, doc_path: str) -> Tuple[Document, List[RAGChunk]]:
+    def parse_document(self, doc_path: str) -> Tuple[Document, List[RAGChunk], List[Tuple[str, str]]]:
         """
         Extract title from PDF. Collect text per section (and per subsection when present).
-        Chunk each section/subsection with SentenceSplitter (size=100, overlap=20).
-        Returns (Document, List[RAGChunk]) with section/subsection set; embedding and knowledge_role filled by embed_chunks.
+        Chunk each section/subsection into sentence-aligned chunks (CHUNK_SIZE / CHUNK_OVERLAP tokens).
+        Returns (Document, List[RAGChunk], (section title, section text) pairs) without calling any API; the summary is filled by
+        summarize_document, and summary and chunk embeddings by embed_documents.
         """
         arxiv_id = self._arxiv_id_from_path(doc_path)
         doc_id = arxiv_id
-        title, abstract = self._extract_title_and_abstract_from_pdf(doc_path)
-        # keywords = self._generate_keywords_with_gpt(abstract) if abstract else []
-
 
+        # Open the PDF once and decode every page once; downstream code indexes page_texts
         reader = PdfReader(doc_path)
+        page_texts = _extract_pages_text(reader.pages)
+        first_page_lines = page_texts[0].split("\n")
+        title, abstract_start = self._parse_first_page(first_page_lines)
+
         chunks_out: List[RAGChunk] = []
         current_section: Optional[str] = "Abstract"
         current_subsection: Optional[str] = None
-        section_content: List[str] = []
-        section_header = re.compile(r"^\s*(\d+(?:\.\d+)*)\s+(.+?)\s*$")
+        # Lines of the current section, joined once in flush()
+        section_lines: List[str] = []
 
-        section_sentences: List[str] = []
+        # (section title, section text) collected during parsing; summarized in one call afterwards
+        pending_sections: List[Tuple[str, str]] = []
 
 
         def flush():
-            if not section_content:
+            if not section_lines:
                 return
-            combined = " ".join(section_content).strip()
+            combined = "\n".join(section_lines).strip()
+            section_lines.clear()
             if not combined:
                 return
 
-            # One sentence per section (condense stage later removes repetition)
-            usage_line = self._extract_section_usage_line(combined)
-            if usage_line:
-                section_sentences.append(usage_line)
+            pending_sections.append((current_subsection or current_section, combined))
 
-            # Split the section into chunks (embeddings filled later by embed_chunks in one batch)
+            # Split the section into chunks (embeddings filled later by embed_documents in one batch)
             for content in self._chunk_section(combined):
                 if content and self._is_proper_chunk_text(content):
                     chunks_out.append(
@@ -217,161 +404,183 @@ class Document_processing:
                             subsection=current_subsection,
                         )
                     )
-            section_content.clear()
-
-
-        # First page: start from after the "Abstract" line (skip title, authors, and "Abstract" header)
-        first_page_text = (reader.pages[0].extract_text() or "").strip()
-        first_page_lines = first_page_text.split("\n")
-        abstract_start = None
-        for i, ln in enumerate(first_page_lines):
-            if re.match(r"^\s*abstract\s*$", ln.strip(), re.IGNORECASE):
-                abstract_start = i + 1
-                break
-        if abstract_start is not None:
-            first_page_from_abstract = "\n".join(first_page_lines[abstract_start:]).strip()
-        else:
-            first_page_from_abstract = first_page_text
-
-        # Full document: abstract body + rest of pages (section content can span many pages)
-        rest_pages = "\n\n".join(
-            (page.extract_text() or "").strip() for page in list(reader.pages)[1:]
-        )
-        full_text = first_page_from_abstract + ("\n\n" + rest_pages if rest_pages.strip() else "")
-        blocks = [b.strip() for b in full_text.split("\n\n") if b.strip()]
-
-
-
-        def _is_references_or_bibliography(title: str) -> bool:
-            t = title.lower()
-            return "references" in t or "bibliography" in t
-
 
 
-        def _is_standalone_references_header(line: str) -> bool:
-            """References section header only: 'References' / 'Bibliography' or '6 References', not titles like 'Learning to Retrieve References'."""
-            s = line.strip()
-            if not s or len(s.split()) > 10:
-                return False
-            t = s.lower()
-            if t in ("references", "bibliography"):
-                return True
-            if re.match(r"^\d+(\.\d+)*\s+(references|bibliography)(\s|$)", t):
-                return True
-            if len(s.split()) <= 4 and (t.startswith("references ") or t.startswith("bibliography ")):
-                return True
-            return False
-
-        def _is_appendix_header(line: str) -> bool:
-            """True if line looks like a page/section title containing 'Appendix' or 'Appendices' — resume chunking after references."""
-            s = line.strip()
-            if not s:
-                return False
-            t = s.lower()
-            if "appendix" not in t and "appendices" not in t:
-                return False
-            # Title-like: short enough to be a heading, not body text
-            words = s.split()
-            return len(words) <= 15 and len(s) <= 120
-
+        # Abstract body (first page after the "Abstract" header; the whole page if there is none) + rest of pages,
+        # streamed line by line (section content can span many pages)
         in_references = False
-        for block in blocks:
-            lines_in_block = block.split("\n")
-            current_part = []
-            for line in lines_in_block:
-                line_stripped = line.strip()
-                if in_references:
-                    if _is_appendix_header(line_stripped):
-                        in_references = False
-                        if current_part:
-                            section_content.append("\n".join(current_part))
-                        flush()
-                        match = section_header.match(line_stripped)
-                        if match and len(line_stripped.split()) <= 15:
-                            if "." in match.groups()[0]:
-                                current_subsection = line_stripped
-                            else:
-                                current_section = line_stripped
-                                current_subsection = None
+        for line in _iter_body_lines(first_page_lines[abstract_start:], page_texts[1:]):
+            kind, match = _classify_line(line, in_references)
+            if in_references:
+                if kind == _LINE_APPENDIX:
+                    in_references = False
+                    flush()
+                    if match:
+                        if "." in match.group(1):
+                            current_subsection = line
                         else:
-                            current_section = line_stripped
+                            current_section = line
                             current_subsection = None
-                        current_part = []
-                    continue
-                if _is_standalone_references_header(line_stripped):
-                    if current_part:
-                        section_content.append("\n".join(current_part))
-                    flush()
-                    in_references = True
-                    continue
-                match = section_header.match(line_stripped)
-                if match and len(line_stripped.split()) <= 15:
-                    section_title = match.group(2).strip()
-                    if current_part:
-                        section_content.append("\n".join(current_part))
-                    flush()
-                    if _is_references_or_bibliography(section_title):
-                        in_references = True
-                        continue
-                    if "." in match.groups()[0]:
-                        current_subsection = line_stripped
                     else:
-                        current_section = line_stripped
+                        current_section = line
                         current_subsection = None
-                    current_part = []
+                continue
+            if kind == _LINE_REFS:
+                flush()
+                in_references = True
+                continue
+            if kind == _LINE_HEADER:
+                flush()
+                if "." in match.group(1):
+                    current_subsection = line
                 else:
-                    current_part.append(line)
-            if not in_references and current_part:
-                section_content.append("\n".join(current_part))
+                    current_section = line
+                    current_subsection = None
+            else:
+                section_lines.append(line)
         if not in_references:
             flush()
 
-        # Condense per-section sentences into one short paragraph (no repetition, consistent)
-        document_summary = self._condense_sentences_to_summary(section_sentences)
-        document_summary_embedding = self._embed_text(document_summary)
         document = Document(
             doc_id=doc_id,
             arxiv_id=arxiv_id,
             title=title,
-            document_summary=document_summary,
-            document_summary_embedding=document_summary_embedding,
         )
-        
 
-        return document, chunks_out
 
+        return document, chunks_out, pending_sections
 
 
 
-    def _embed_text(self, text: str) -> Optional[List[float]]:
-        """Embed a single text with OpenAI text-embedding-3-small. Returns None for empty text."""
-        if not text or not text.strip():
-            return None
-        client = OpenAI()
-        resp = client.embeddings.create(
-            model="text-embedding-3-small",
-            input=[text.strip()],
-        )
-        if not resp.data:
-            return None
-        return resp.data[0].embedding
 
+    def summarize_document(self, document: Document, sections: List[Tuple[str, str]]) -> Document:
+        """Fill document.document_summary from the (section title, section text) pairs collected by parse_document."""
+        document.document_summary = self._summarize_document(sections)
+        return document
 
 
 
-    def embed_chunks(self, document: Document, chunks: List[RAGChunk]) -> List[RAGChunk]:
-        """Embed all chunks in one batch (OpenAI text-embedding-3-small) and fill chunk.embedding."""
-        if not chunks:
+
+    def process_document(self, doc_path: str) -> Tuple[Document, List[RAGChunk]]:
+        """Parse one PDF and summarize it. Returns (Document, List[RAGChunk]); embeddings filled by embed_documents."""
+        document, chunks, sections = self.parse_document(doc_path)
+        return self.summarize_document(document, sections), chunks
+
+
+
+
+    async def _embed_all(
+        self, texts: List[str], on_batch: Optional[Callable[[int, List[List[float]]], None]] = None
+    ) -> List[List[float]]:
+        """
+        Embed texts in sub-batches (<= EMBED_MAX_INPUTS inputs / EMBED_MAX_TOKENS tokens) sent concurrently; keeps input order.
+        on_batch(start, vectors) is called as soon as each batch returns, so callers can persist partial progress.
+        """
+        if not texts:
             return []
-        client = OpenAI()
-        texts = [c.content for c in chunks]
-        resp = client.embeddings.create(
-            model="text-embedding-3-small",
-            input=texts,
-        )
-        embeddings = [e.embedding for e in resp.data]
-        for chunk, emb in zip(chunks, embeddings):
-            chunk.embedding = emb
+        enc = _encoding()
+        counts = [len(enc.encode_ordinary(text)) for text in texts]
+        batches: List[Tuple[int, int]] = []
+        start, tokens = 0, 0
+        for i, n_tokens in enumerate(counts):
+            if i > start and (i - start >= EMBED_MAX_INPUTS or tokens + n_tokens > EMBED_MAX_TOKENS):
+                batches.append((start, i))
+                start, tokens = i, 0
+            tokens += n_tokens
+        batches.append((start, len(texts)))
+
+        semaphore = asyncio.Semaphore(EMBED_MAX_CONCURRENCY)
+        embeddings: List[Optional[List[float]]] = [None] * len(texts)
+
+        async def embed_batch(lo: int, hi: int) -> None:
+            try:
+                async with semaphore:
+                    resp = await client.embeddings.create(model=EMBEDDING_MODEL, input=texts[lo:hi])
+            except BadRequestError as e:
+                # Only a too-long request is retried as two halves (a single input cannot be split). Other 400s,
+                # and rate limits (already retried with backoff by the SDK), surface as they are.
+                if hi - lo == 1 or not _is_context_length_error(e):
+                    raise
+                mid = (lo + hi) // 2
+                await _gather_all(embed_batch(lo, mid), embed_batch(mid, hi))
+                return
+            vectors = [e.embedding for e in resp.data]
+            embeddings[lo:hi] = vectors
+            if on_batch is not None:
+                on_batch(lo, vectors)
+
+        # Async clients are bound to the event loop, so one per asyncio.run, closed before the loop is
+        async with AsyncOpenAI(timeout=OPENAI_TIMEOUT, max_retries=OPENAI_MAX_RETRIES) as client:
+            await _gather_all(*(embed_batch(lo, hi) for lo, hi in batches))
+        return embeddings
+
+
+
+
+    async def _embed_unique(self, texts: List[str]) -> List[List[float]]:
+        """
+        Embed texts sending each distinct content (by _content_key) only once; vectors are scattered back in input order.
+        Vectors are kept in a disk cache (EMBED_CACHE_DIR), so re-ingesting already seen content costs no API call.
+        """
+        index_by_key = {}
+        unique_keys: List[Tuple[str, bytes]] = []
+        unique_texts: List[str] = []
+        inverse: List[int] = []
+        for text in texts:
+            key = (EMBEDDING_MODEL, _content_key(text))
+            idx = index_by_key.get(key)
+            if idx is None:
+                idx = index_by_key[key] = len(unique_texts)
+                unique_keys.append(key)
+                unique_texts.append(text)
+            inverse.append(idx)
+
+        with diskcache.Cache(EMBED_CACHE_DIR) as cache:
+            unique_embeddings = [cache.get(key) for key in unique_keys]
+            misses = [i for i, emb in enumerate(unique_embeddings) if emb is None]
+            if misses:
+                # Cache each batch as soon as it returns: a later failed batch does not lose vectors already paid for
+                def cache_batch(start: int, vectors: List[List[float]]) -> None:
+                    with cache.transact():
+                        for i, emb in zip(misses[start:], vectors):
+                            unique_embeddings[i] = emb
+                            cache.set(unique_keys[i], emb)
+
+                await self._embed_all([unique_texts[i] for i in misses], on_batch=cache_batch)
+        return [unique_embeddings[idx] for idx in inverse]
+
+
+
+
+    def embed_documents(
+        self, parsed: List[Tuple[Document, List[RAGChunk]]]
+    ) -> List[Tuple[Document, List[RAGChunk]]]:
+        """Embed every document summary and chunk of the corpus in one flat batch, then scatter vectors back by offset."""
+        texts: List[str] = []
+        offsets: List[Tuple[Optional[int], int]] = []
+        for document, chunks in parsed:
+            summary = document.document_summary.strip()
+            summary_idx = None
+            if summary:
+                summary_idx = len(texts)
+                texts.append(summary)
+            offsets.append((summary_idx, len(texts)))
+            texts.extend(c.content for c in chunks)
+
+        embeddings = asyncio.run(self._embed_unique(texts))
+
+        for (document, chunks), (summary_idx, chunk_start) in zip(parsed, offsets):
+            document.document_summary_embedding = embeddings[summary_idx] if summary_idx is not None else None
+            for offset, chunk in enumerate(chunks):
+                chunk.embedding = embeddings[chunk_start + offset]
+        return parsed
+
+
+
+
+    def embed_chunks(self, document: Document, chunks: List[RAGChunk]) -> List[RAGChunk]:
+        """Embed one document's summary and chunks (OpenAI text-embedding-3-small) and fill the embedding fields."""
+        self.embed_documents([(document, chunks)])
         return chunks
 
 
@@ -382,19 +591,24 @@ class Document_processing:
         """Remove null bytes and other control chars PostgreSQL text columns reject."""
         if s is None:
             return None
-        return "".join(c for c in s if c != "\x00" and (ord(c) >= 32 or c in "\n\r\t"))
-
-    def store_document(self, document: Document) -> None:
-        """Insert or upsert the document into Supabase table 'documents'."""
-        row = {
-            "doc_id": document.doc_id,
-            "arxiv_id": document.arxiv_id,
-            "title": self._sanitize_text_for_db(document.title) or "",
-            "document_summary": self._sanitize_text_for_db(document.document_summary) or "",
-            "document_summary_embedding": document.document_summary_embedding,
-        }
+        return s.translate(_SANITIZE_TABLE)
+
+    def store_documents(self, documents: List[Document]) -> None:
+        """Upsert all documents into Supabase table 'documents' in a single request."""
+        if not documents:
+            return
+        rows = [
+            {
+                "doc_id": document.doc_id,
+                "arxiv_id": document.arxiv_id,
+                "title": self._sanitize_text_for_db(document.title) or "",
+                "document_summary": self._sanitize_text_for_db(document.document_summary) or "",
+                "document_summary_embedding": document.document_summary_embedding,
+            }
+            for document in documents
+        ]
         self.supabase_client.table("documents").upsert(
-            row,
+            rows,
             on_conflict="doc_id",
         ).execute()
 
@@ -402,11 +616,11 @@ class Document_processing:
 
 
     def store_chunks(self, chunks: List[RAGChunk]) -> None:
-        """Delete existing chunks for this doc, then insert the new chunks."""
+        """Delete existing chunks of every doc in one statement, then insert the new chunks in concurrent batches."""
         if not chunks:
             return
-        doc_id = chunks[0].doc_id
-        self.supabase_client.table("chunks").delete().eq("doc_id", doc_id).execute()
+        doc_ids = list(dict.fromkeys(chunk.doc_id for chunk in chunks))
+        self.supabase_client.table("chunks").delete().in_("doc_id", doc_ids).execute()
         rows = [
             {
                 "doc_id": chunk.doc_id,
@@ -417,23 +631,26 @@ class Document_processing:
             }
             for chunk in chunks
         ]
-        self.supabase_client.table("chunks").insert(rows).execute()
+        batches = [rows[i : i + STORE_BATCH_SIZE] for i in range(0, len(rows), STORE_BATCH_SIZE)]
+        with ThreadPoolExecutor(max_workers=min(STORE_MAX_WORKERS, len(batches))) as executor:
+            # list() surfaces the first failed insert
+            list(executor.map(lambda batch: self.supabase_client.table("chunks").insert(batch).execute(), batches))
 
 
 
 
     def process_and_store_docs(self):
-        for doc_path in self.documents:
-            print(f"Processing {doc_path}")
-            document, chunks = self.process_document(doc_path)
-            chunks = self.embed_chunks(document, chunks)
-            
-            self.store_document(document)
-            self.store_chunks(chunks)
-
-
-
-
-
+        # Phase 1: parse every PDF in a process pool (CPU-bound, no API calls in the workers)
+        with ProcessPoolExecutor(max_workers=self.num_workers) as executor:
+            results = list(executor.map(_parse_one, self.documents, chunksize=1))
 
+        # Phase 2: summarize each document, then embed summaries and chunks of the whole corpus together
+        parsed: List[Tuple[Document, List[RAGChunk]]] = []
+        for doc_path, (document, chunks, sections) in zip(self.documents, results):
+            print(f"Processing {doc_path}")
+            parsed.append((self.summarize_document(document, sections), chunks))
+        self.embed_documents(parsed)
 
+        # Phase 3: store the whole corpus (one documents upsert, batched chunk inserts)
+        self.store_documents([document for document, _ in parsed])
+        self.store_chunks([chunk for _, chunks in parsed for chunk in chunks])